@@ -36,7 +36,9 @@ __author__ = "Dmitry Vasiliev <dima@hlabs.org>"
 from struct import Struct
 from array import array
 from zlib import decompressobj, compress
+from itertools import repeat
 from cPickle import loads, dumps
+from types import FunctionType
 
 
 # It seems protocol version 2 is supported by all Python versions
@@ -47,8 +49,13 @@ class IncompleteData(ValueError):
     """Need more data."""
 
     def __init__(self, data):
+        # Incomplete data is a normal condition when decoding a stream and
+        # the data can be large so the message is formatted only on demand
         self.data = data
-        ValueError.__init__(self, "incomplete data: %r" % (data,))
+        ValueError.__init__(self, data)
+
+    def __str__(self):
+        return "incomplete data: %r" % (self.data,)
 
 
 class Atom(str):
@@ -158,12 +165,17 @@ class OpaqueObject(object):
 
 _python = Atom("python")
 
-_int4_unpack = Struct(">I").unpack
-_int2_unpack = Struct(">H").unpack
-_signed_int4_unpack = Struct(">i").unpack
-_float_unpack = Struct(">d").unpack
-_double_bytes_unpack = Struct("BB").unpack
-_int4_byte_unpack = Struct(">IB").unpack
+_int4_unpack_from = Struct(">I").unpack_from
+_int2_unpack_from = Struct(">H").unpack_from
+_signed_int4_unpack_from = Struct(">i").unpack_from
+_float_unpack_from = Struct(">d").unpack_from
+_double_bytes_unpack_from = Struct("BB").unpack_from
+_int4_byte_unpack_from = Struct(">IB").unpack_from
+_little_int8_unpack_from = Struct("<Q").unpack_from
+
+# Decoded atoms by name. Atom instances are interned by the Atom class anyway
+# so the cache only saves the constructor call on every decoded atom.
+_decoded_atoms = {"true": True, "false": False, "undefined": None}
 
 
 def decode(string):
@@ -173,139 +185,344 @@ def decode(string):
     if string[0] != '\x83':
         raise ValueError("unknown protocol version: %r" % string[0])
     if string[1:2] == 'P':
-        # compressed term
-        if len(string) < 16:
-            raise IncompleteData(string)
-        d = decompressobj()
-        term_string = d.decompress(string[6:]) + d.flush()
-        uncompressed_size, = _int4_unpack(string[2:6])
-        if len(term_string) != uncompressed_size:
-            raise ValueError(
-                "invalid compressed tag, "
-                "%d bytes but got %d" % (uncompressed_size, len(term_string)))
-        # tail data returned by decode_term() can be simple ignored
-        term, _tail = decode_term(term_string)
-        return term, d.unused_data
-    return decode_term(string[1:])
-
-
-def decode_term(string,
+        # compressed term, tail data is what left after the zlib stream
+        return _decode_compressed(string, 0)
+    term, pos = decode_term(string, 1)
+    return term, string[pos:]
+
+
+def decode_into(data, offset=0, zero_copy=False):
+    """Decode Erlang external term from a buffer at the given offset.
+
+    The data can be any object supporting the buffer interface (str,
+    bytearray, buffer, etc.) and is not copied, so the same buffer can be
+    reused for incoming messages. Returns a tuple of the decoded term and the
+    offset of the first byte after the term.
+
+    If zero_copy is true binaries are returned as buffer objects pointing to
+    the data (except for compressed terms) and are only valid until the data
+    is changed.
+
+    On IncompleteData the exception data is a copy of the data starting at
+    the offset so the buffer can be extended and decoded again.
+    """
+    string = buffer(data)
+    try:
+        if len(string) <= offset:
+            raise IncompleteData("")
+        if string[offset] != '\x83':
+            raise ValueError("unknown protocol version: %r" % string[offset])
+        if string[offset + 1:offset + 2] == 'P':
+            term, tail = _decode_compressed(string, offset)
+            return term, len(string) - len(tail)
+        if zero_copy:
+            return _decode_zero_copy_term(string, offset + 1)
+        return decode_term(string, offset + 1)
+    except IncompleteData:
+        # Report all the data starting at the offset as in Python 3
+        pass
+    raise IncompleteData(string[offset:])
+
+
+def _decode_compressed(string, pos,
         # Hack to turn globals into locals
-        len=len, ord=ord, tuple=tuple, float=float, array=array,
-        int4_unpack=_int4_unpack, int2_unpack=_int2_unpack,
-        signed_int4_unpack=_signed_int4_unpack, float_unpack=_float_unpack,
-        double_bytes_unpack=_double_bytes_unpack,
-        int4_byte_unpack=_int4_byte_unpack, Atom=Atom,
-        opaque=OpaqueObject.marker, decode_opaque=OpaqueObject.decode):
-    if not string:
-        raise IncompleteData(string)
-    tag = string[0]
-    if tag == "d":
-        # ATOM_EXT
-        ln = len(string)
-        if ln < 3:
-            raise IncompleteData(string)
-        length = int2_unpack(string[1:3])[0] + 3
-        if ln < length:
-            raise IncompleteData(string)
-        name = string[3:length]
-        if name == "true":
-            return True, string[length:]
-        elif name == "false":
-            return False, string[length:]
-        elif name == "undefined":
-            return None, string[length:]
-        return Atom(name), string[length:]
-    elif tag == "j":
-        # NIL_EXT
-        return List(), string[1:]
-    elif tag == "k":
-        # STRING_EXT
-        ln = len(string)
-        if ln < 3:
-            raise IncompleteData(string)
-        length = int2_unpack(string[1:3])[0] + 3
-        if ln < length:
-            raise IncompleteData(string)
-        return List(array("B", string[3:length]).tolist()), string[length:]
-    elif tag in "lhi":
-        # LIST_EXT, SMALL_TUPLE_EXT, LARGE_TUPLE_EXT
-        if tag == "h":
-            if len(string) < 2:
-                raise IncompleteData(string)
-            length = ord(string[1])
-            tail = string[2:]
-        else:
-            if len(string) < 5:
-                raise IncompleteData(string)
-            length, = int4_unpack(string[1:5])
-            tail = string[5:]
+        len=len, int4_unpack_from=_int4_unpack_from):
+    if len(string) < pos + 16:
+        raise IncompleteData(string[pos:])
+    uncompressed_size, = int4_unpack_from(string, pos + 2)
+    d = decompressobj()
+    # Decompress from a view to not copy the compressed data. Output is
+    # limited to the declared size (plus one byte to detect a mismatch)
+    # so the peak memory is bounded by the header and not by whatever
+    # the compressed stream expands to.
+    term_string = d.decompress(buffer(string, pos + 6), uncompressed_size + 1)
+    if len(term_string) > uncompressed_size:
+        raise ValueError(
+            "invalid compressed tag, "
+            "%d bytes but got more" % uncompressed_size)
+    # All input is consumed at this point so flush() can only return
+    # the last few bytes of the stream
+    flushed = d.flush()
+    if flushed:
+        term_string += flushed
+    if len(term_string) != uncompressed_size:
+        raise ValueError(
+            "invalid compressed tag, "
+            "%d bytes but got %d" % (uncompressed_size, len(term_string)))
+    # tail data returned by decode_term() can be simple ignored
+    term, _pos = decode_term(term_string, 0)
+    return term, d.unused_data
+
+
+def _decode_atom(string, pos,
+        # Hack to turn globals into locals
+        len=len, int2_unpack_from=_int2_unpack_from, Atom=Atom,
+        atoms=_decoded_atoms):
+    # ATOM_EXT
+    ln = len(string)
+    if ln < pos + 3:
+        raise IncompleteData(string[pos:])
+    end = int2_unpack_from(string, pos + 1)[0] + pos + 3
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    name = string[pos + 3:end]
+    try:
+        return atoms[name], end
+    except KeyError:
+        atom = atoms[name] = Atom(name)
+        return atom, end
+
+
+def _decode_nil(string, pos, List=List):
+    # NIL_EXT
+    return List(), pos + 1
+
+
+def _decode_string(string, pos,
+        # Hack to turn globals into locals
+        len=len, int2_unpack_from=_int2_unpack_from, List=List, array=array):
+    # STRING_EXT
+    ln = len(string)
+    if ln < pos + 3:
+        raise IncompleteData(string[pos:])
+    end = int2_unpack_from(string, pos + 1)[0] + pos + 3
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    return List(array("B", string[pos + 3:end])), end
+
+
+def _decode_list(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from, List=List,
+        ImproperList=ImproperList, repeat=repeat, xrange=xrange):
+    # LIST_EXT
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    length, = int4_unpack_from(string, pos + 1)
+    i = pos + 5
+    # Every element and the tail take at least one byte
+    if ln <= i + length:
+        raise IncompleteData(string[pos:])
+    _decode_term = decode_term
+    if length <= 4:
+        # Appending is faster for short lists
         lst = List()
         append = lst.append
-        _decode_term = decode_term
         while length > 0:
-            term, tail = _decode_term(tail)
+            term, i = _decode_term(string, i)
             append(term)
             length -= 1
-        if tag == "l":
-            if not tail:
-                raise IncompleteData(string)
-            if tail[0] != "j":
-                improper_tail, tail = _decode_term(tail)
-                return ImproperList(lst, improper_tail), tail
-            return lst, tail[1:]
-        if len(lst) == 3 and lst[0] == opaque:
-            return decode_opaque(lst[2], lst[1]), tail
-        return tuple(lst), tail
-    elif tag == "a":
-        # SMALL_INTEGER_EXT
-        if len(string) < 2:
-            raise IncompleteData(string)
-        return ord(string[1]), string[2:]
-    elif tag == "b":
-        # INTEGER_EXT
-        if len(string) < 5:
-            raise IncompleteData(string)
-        i, = signed_int4_unpack(string[1:5])
-        return i, string[5:]
-    elif tag == "m":
-        # BINARY_EXT
-        ln = len(string)
-        if ln < 5:
-            raise IncompleteData(string)
-        length = int4_unpack(string[1:5])[0] + 5
-        if ln < length:
-            raise IncompleteData(string)
-        return string[5:length], string[length:]
-    elif tag == "F":
-        # NEW_FLOAT_EXT
-        if len(string) < 9:
-            raise IncompleteData(string)
-        f, = float_unpack(string[1:9])
-        return f, string[9:]
-    elif tag in "no":
-        # SMALL_BIG_EXT, LARGE_BIG_EXT
-        if tag == "n":
-            if len(string) < 3:
-                raise IncompleteData(string)
-            length, sign = double_bytes_unpack(string[1:3])
-            tail = string[3:]
-        else:
-            if len(string) < 6:
-                raise IncompleteData(string)
-            length, sign = int4_byte_unpack(string[1:6])
-            tail = string[6:]
-        if len(tail) < length:
-            raise IncompleteData(string)
-        n = 0
-        if length:
-            for i in array("B", tail[length-1::-1]):
-                n = (n << 8) | i
-            if sign:
-                n = -n
-        return n, tail[length:]
-
-    raise ValueError("unsupported data: %r" % (string,))
+    else:
+        lst = List(repeat(None, length))
+        for n in xrange(length):
+            lst[n], i = _decode_term(string, i)
+    if ln <= i:
+        raise IncompleteData(string[pos:])
+    if string[i] != "j":
+        improper_tail, i = _decode_term(string, i)
+        return ImproperList(lst, improper_tail), i
+    return lst, i + 1
+
+
+def _decode_small_tuple(string, pos, len=len, ord=ord):
+    # SMALL_TUPLE_EXT
+    if len(string) < pos + 2:
+        raise IncompleteData(string[pos:])
+    return _decode_tuple(string, pos + 2, ord(string[pos + 1]))
+
+
+def _decode_large_tuple(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from):
+    # LARGE_TUPLE_EXT
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    arity, = int4_unpack_from(string, pos + 1)
+    # Every element takes at least one byte
+    if ln < pos + 5 + arity:
+        raise IncompleteData(string[pos:])
+    return _decode_tuple(string, pos + 5, arity)
+
+
+def _decode_tuple(string, pos, arity,
+        # Hack to turn globals into locals
+        len=len, tuple=tuple, xrange=xrange, opaque=OpaqueObject.marker,
+        decode_opaque=OpaqueObject.decode, buffer=buffer, str=str):
+    _decode_term = decode_term
+    if arity <= 4:
+        # Appending is faster for small tuples
+        lst = []
+        append = lst.append
+        while arity > 0:
+            term, pos = _decode_term(string, pos)
+            append(term)
+            arity -= 1
+    else:
+        lst = [None] * arity
+        for n in xrange(arity):
+            lst[n], pos = _decode_term(string, pos)
+    if len(lst) == 3 and lst[0] == opaque:
+        data = lst[2]
+        if type(data) is buffer:
+            # decode_into(..., zero_copy=True)
+            data = str(data)
+        return decode_opaque(data, lst[1]), pos
+    return tuple(lst), pos
+
+
+def _decode_small_integer(string, pos, len=len, ord=ord):
+    # SMALL_INTEGER_EXT
+    if len(string) < pos + 2:
+        raise IncompleteData(string[pos:])
+    return ord(string[pos + 1]), pos + 2
+
+
+def _decode_integer(string, pos,
+        # Hack to turn globals into locals
+        len=len, signed_int4_unpack_from=_signed_int4_unpack_from):
+    # INTEGER_EXT
+    if len(string) < pos + 5:
+        raise IncompleteData(string[pos:])
+    i, = signed_int4_unpack_from(string, pos + 1)
+    return i, pos + 5
+
+
+def _decode_binary(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from):
+    # BINARY_EXT
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    end = int4_unpack_from(string, pos + 1)[0] + pos + 5
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    return string[pos + 5:end], end
+
+
+def _decode_zero_copy_binary(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from, buffer=buffer):
+    # BINARY_EXT as a buffer object pointing to the data
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    length, = int4_unpack_from(string, pos + 1)
+    if ln < pos + 5 + length:
+        raise IncompleteData(string[pos:])
+    return buffer(string, pos + 5, length), pos + 5 + length
+
+
+def _decode_float(string, pos,
+        # Hack to turn globals into locals
+        len=len, float_unpack_from=_float_unpack_from):
+    # NEW_FLOAT_EXT
+    if len(string) < pos + 9:
+        raise IncompleteData(string[pos:])
+    f, = float_unpack_from(string, pos + 1)
+    return f, pos + 9
+
+
+def _decode_small_big_integer(string, pos,
+        # Hack to turn globals into locals
+        len=len, double_bytes_unpack_from=_double_bytes_unpack_from):
+    # SMALL_BIG_EXT
+    if len(string) < pos + 3:
+        raise IncompleteData(string[pos:])
+    length, sign = double_bytes_unpack_from(string, pos + 1)
+    return _decode_big_integer(string, pos, pos + 3, length, sign)
+
+
+def _decode_large_big_integer(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_byte_unpack_from=_int4_byte_unpack_from):
+    # LARGE_BIG_EXT
+    if len(string) < pos + 6:
+        raise IncompleteData(string[pos:])
+    length, sign = int4_byte_unpack_from(string, pos + 1)
+    return _decode_big_integer(string, pos, pos + 6, length, sign)
+
+
+def _decode_big_integer(string, pos, start, length, sign,
+        # Hack to turn globals into locals
+        len=len, int=int, little_int8_unpack_from=_little_int8_unpack_from,
+        zeros="\0" * 8):
+    end = start + length
+    if len(string) < end:
+        raise IncompleteData(string[pos:])
+    if length == 8:
+        # Integers up to 64 bits are the most common ones and unpacking
+        # them is about three times faster than the hex conversion below
+        n, = little_int8_unpack_from(string, start)
+    elif length < 8:
+        n, = little_int8_unpack_from(string[start:end] + zeros)
+    else:
+        # Hex conversion of the reversed (big-endian) bytes is done in C
+        n = int(string[end - 1:start - 1:-1].encode("hex"), 16)
+    if sign:
+        n = -n
+    return n, end
+
+
+# Term decoders by tag
+_decoders = {
+    "d": _decode_atom,
+    "j": _decode_nil,
+    "k": _decode_string,
+    "l": _decode_list,
+    "h": _decode_small_tuple,
+    "i": _decode_large_tuple,
+    "a": _decode_small_integer,
+    "b": _decode_integer,
+    "m": _decode_binary,
+    "F": _decode_float,
+    "n": _decode_small_big_integer,
+    "o": _decode_large_big_integer,
+    }
+
+
+def decode_term(string, pos,
+        # Hack to turn globals into locals
+        len=len, decoders=_decoders):
+    """Decode Erlang term starting at the given position of the string.
+
+    Returns a tuple of the decoded term and the position of the first byte
+    after the term.
+    """
+    if len(string) <= pos:
+        raise IncompleteData(string[pos:])
+    decoder = decoders.get(string[pos])
+    if decoder is None:
+        raise ValueError("unsupported data: %r" % (string[pos:],))
+    return decoder(string, pos)
+
+
+def _make_decode_term(replaced, FunctionType=FunctionType):
+    """Make a copy of decode_term() with some of the tag decoders replaced.
+
+    List and tuple decoders are copied too with the new decode_term() in
+    their globals so nested terms are decoded by the same decoders without
+    passing them around on every call.
+    """
+    namespace = dict(globals())
+    decoders = dict(replaced)
+    for function in (_decode_list, _decode_small_tuple, _decode_large_tuple,
+            _decode_tuple):
+        decoders[function] = namespace[function.__name__] = FunctionType(
+            function.func_code, namespace, function.__name__,
+            function.func_defaults)
+    function = namespace["decode_term"] = FunctionType(
+        decode_term.func_code, namespace, "decode_term",
+        (len, dict((tag, decoders.get(d, d))
+            for tag, d in _decoders.iteritems())))
+    return function
+
+# decode_term() version used by decode_into(..., zero_copy=True)
+_decode_zero_copy_term = _make_decode_term({
+    _decode_binary: _decode_zero_copy_binary,
+    })
 
 _int4_pack = Struct(">I").pack
 _char_int4_pack = Struct(">cI").pack
@@ -315,9 +532,38 @@ _char_float_pack = Struct(">cd").pack
 _char_2bytes_pack = Struct("cBB").pack
 _char_int4_byte_pack = Struct(">cIB").pack
 
+try:
+    bytearray
+except NameError:
+    # Python 2.5
+    def _pack_bytes(items, array=array):
+        return array('B', items).tostring()
+else:
+    # bytearray() is about three times faster than array()
+    def _pack_bytes(items, str=str, bytearray=bytearray):
+        return str(bytearray(items))
+
+# Encoded atoms by atom. The cache size is limited so applications which
+# create a lot of distinct atoms don't fill it with rarely used ones.
+_encoded_atoms = {}
+_MAX_ENCODED_ATOMS = 1024
+
+# Precomputed SMALL_INTEGER_EXT terms and SMALL_TUPLE_EXT/ATOM_EXT headers
+# indexed by value/arity/length. Indexing is faster than Struct.pack() or
+# string formatting.
+_small_integers = ["a%c" % i for i in xrange(256)]
+_small_tuple_headers = ["h%c" % i for i in xrange(256)]
+_atom_headers = ["d\0%c" % i for i in xrange(256)]
+
+# Minimal number of items in a tuple to try to encode them all at once as
+# small integers
+_MIN_BATCHED_ITEMS = 16
+
 def encode(term, compressed=False):
     """Encode Erlang external term."""
-    encoded_term = encode_term(term)
+    out = ["\x83"]
+    _encode_term(term, out)
+    data = "".join(out)
     # False and 0 do not attempt compression.
     if compressed:
         if compressed is True:
@@ -325,108 +571,367 @@ def encode(term, compressed=False):
             compressed = 6
         elif compressed < 0 or compressed > 9:
             raise ValueError("invalid compression level: %r" % (compressed,))
-        zlib_term = compress(encoded_term, compressed)
-        ln = len(encoded_term)
+        zlib_term = compress(buffer(data, 1), compressed)
+        ln = len(data) - 1
         if len(zlib_term) + 5 <= ln:
             # Compressed term should be smaller
             return '\x83P' + _int4_pack(ln) + zlib_term
-    return "\x83" + encoded_term
+    return data
+
+
+def encode_term(term):
+    """Encode Erlang term without the protocol version byte."""
+    out = []
+    _encode_term(term, out)
+    return "".join(out)
+
+
+def make_encoder(template):
+    """Make a function to encode terms of the same shape as the template.
+
+    Tuples in the template are followed recursively, types are placeholders
+    for the function arguments (in the same order) and all other values are
+    constants which are encoded only once. The function returns the same
+    data as encode() of the whole uncompressed term:
+
+        encode_call = make_encoder((Atom("call"), Atom, Atom, list))
+        data = encode_call(Atom("module"), Atom("function"), [1, 2, 3])
+
+    Arguments whose type is not exactly the placeholder type are encoded as
+    by encode(). The returned function should be kept and reused since
+    making it is much slower than encoding a term.
+    """
+    parts = ["\x83"]
+    _split_template(template, parts)
+    # Generate straight-line code with the encoders for the placeholder
+    # types called directly instead of looking them up for every term
+    names = {"join": "".join, "type": type, "_encode_term": _encode_term}
+    args = []
+    lines = []
+    for n, part in enumerate(parts):
+        if type(part) is str:
+            names["c%d" % n] = part
+            if lines:
+                lines.append("append(c%d)" % n)
+            else:
+                lines.append("out = [c%d]" % n)
+                lines.append("append = out.append")
+            continue
+        arg = "a%d" % len(args)
+        args.append(arg)
+        encoder = _encoders.get(part)
+        if encoder is None:
+            lines.append("_encode_term(%s, out)" % arg)
+        else:
+            names["t%d" % n] = part
+            names["e%d" % n] = encoder
+            lines.append("if type(%s) is t%d:" % (arg, n))
+            lines.append("    e%d(%s, out)" % (n, arg))
+            lines.append("else:")
+            lines.append("    _encode_term(%s, out)" % arg)
+    lines.append("return join(out)")
+    params = ", ".join(args)
+    if len(args) > 255:
+        # Python before 3.7 doesn't allow more than 255 arguments
+        lines.insert(0, "%s, = args" % params)
+        params = "*args"
+    # Constants and encoders are assigned to local variables of the outer
+    # function to make them closure variables which are faster than globals
+    source = ("def make(names):\n%s\n    def encoder(%s):\n%s\n"
+        "    return encoder" % (
+        "\n".join("    %s = names[%r]" % (name, name) for name in names),
+        params, "\n".join("        " + line for line in lines)))
+    namespace = {}
+    exec source in namespace
+    return namespace["make"](names)
+
+
+def _split_template(template, parts,
+        # Hack to turn globals into locals
+        isinstance=isinstance, type=type, len=len, str=str,
+        char_int4_pack=_char_int4_pack,
+        small_tuple_headers=_small_tuple_headers):
+    # Append encoded constants and placeholder types of the template to the
+    # parts list merging consecutive constants
+    if isinstance(template, type):
+        parts.append(template)
+        return
+    is_tuple = type(template) is tuple
+    if is_tuple:
+        arity = len(template)
+        if arity < 256:
+            data = small_tuple_headers[arity]
+        else:
+            data = char_int4_pack("i", arity)
+    else:
+        data = encode_term(template)
+    if type(parts[-1]) is str:
+        parts[-1] += data
+    else:
+        parts.append(data)
+    if is_tuple:
+        for item in template:
+            _split_template(item, parts)
+
+
+def _encode_tuple(term, out,
+        # Hack to turn globals into locals
+        len=len, type=type, map=map, pack_bytes=_pack_bytes,
+        char_int4_pack=_char_int4_pack,
+        small_tuple_headers=_small_tuple_headers,
+        min_batched=_MIN_BATCHED_ITEMS, int_types=frozenset((int, long))):
+    arity = len(term)
+    if arity <= 255:
+        out.append(small_tuple_headers[arity])
+    elif arity <= 4294967295:
+        out.append(char_int4_pack('i', arity))
+    else:
+        raise ValueError("invalid tuple arity: %r" % arity)
+    if (arity >= min_batched and type(term[0]) in int_types
+            and type(term[-1]) in int_types
+            and int_types.issuperset(map(type, term))):
+        # All items are integers, if they are also small integers encode
+        # them all at once
+        try:
+            b = pack_bytes(term)
+        except (ValueError, OverflowError):
+            pass
+        else:
+            # Interleave SMALL_INTEGER_EXT tags with the values
+            out.append("a")
+            out.append("a".join(b))
+            return
+    get = _encoders.get
+    for item in term:
+        get(type(item), _encode_python)(item, out)
 
 
-def encode_term(term,
+def _encode_list(term, out,
         # Hack to turn globals into locals
-        tuple=tuple, len=len, list=list, int=int, long=long, type=type,
-        array=array, unicode=unicode, Atom=Atom, str=str, map=map, float=float,
-        ord=ord, dict=dict, True=True, False=False, dumps=dumps,
-        PICKLE_PROTOCOL=PICKLE_PROTOCOL, OpaqueObject=OpaqueObject,
-        ImproperList=ImproperList, char_int4_pack=_char_int4_pack,
-        char_int2_pack=_char_int2_pack,
-        char_signed_int4_pack=_char_signed_int4_pack, List=List,
-        char_float_pack=_char_float_pack, char_2bytes_pack=_char_2bytes_pack,
-        char_int4_byte_pack=_char_int4_byte_pack, python=_python):
-    t = type(term)
-    if t is tuple:
-        arity = len(term)
-        if arity <= 255:
-            header = "h%c" % arity
-        elif arity <= 4294967295:
-            header = char_int4_pack('i', arity)
-        else:
-            raise ValueError("invalid tuple arity: %r" % arity)
-        return header + "".join(map(encode_term, term))
-    elif t is list or t is List:
-        length = len(term)
-        if not term:
-            return "j"
-        elif length <= 65535:
+        len=len, type=type, map=map, pack_bytes=_pack_bytes,
+        char_int4_pack=_char_int4_pack, char_int2_pack=_char_int2_pack,
+        int_types=frozenset((int, long))):
+    length = len(term)
+    if not term:
+        out.append("j")
+        return
+    elif length <= 65535:
+        # Packing will allow floats as a deprecated feature in Python 2.6
+        # and previous versions (and bools are ints) so check the element
+        # types first. The check is done in a single C level pass instead
+        # of a Python loop.
+        if int_types.issuperset(map(type, term)):
             try:
-                # Array coersion will allow floats as a deprecated feature in
-                # Python 2.6 and previous versions
-                for t in term:
-                    typ = type(t)
-                    if not (typ is int or typ is long):
-                        raise TypeError
-                b = array('B', term).tostring()
-            except (TypeError, OverflowError):
+                b = pack_bytes(term)
+            except (ValueError, OverflowError):
                 pass
             else:
-                return char_int2_pack('k', length) + b
-        elif length > 4294967295:
-            raise ValueError("invalid list length: %r" % length)
-        return (char_int4_pack('l', length)
-            + "".join(map(encode_term, term)) + "j")
-    elif t is unicode:
-        return encode_term(map(ord, term))
-    elif t is Atom:
-        return char_int2_pack('d', len(term)) + term
-    elif t is str:
-        length = len(term)
-        if length > 4294967295:
-            raise ValueError("invalid binary length: %r" % length)
-        return char_int4_pack('m', length) + term
-    elif term is True:
-        return "d\0\4true"
-    elif term is False:
-        return "d\0\5false"
-    elif t is int or t is long:
-        if 0 <= term <= 255:
-            return 'a%c' % term
-        elif -2147483648 <= term <= 2147483647:
-            return char_signed_int4_pack('b', term)
-
-        if term >= 0:
-            sign = 0
+                out.append(char_int2_pack('k', length))
+                out.append(b)
+                return
+    elif length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    elif (type(term[0]) in int_types and type(term[-1]) in int_types
+            and int_types.issuperset(map(type, term))):
+        # Too long for STRING_EXT but if all items are small integers they
+        # still can be encoded all at once
+        try:
+            b = pack_bytes(term)
+        except (ValueError, OverflowError):
+            pass
+        else:
+            # Interleave SMALL_INTEGER_EXT tags with the values
+            out.append(char_int4_pack('l', length))
+            out.append("a")
+            out.append("a".join(b))
+            out.append("j")
+            return
+    out.append(char_int4_pack('l', length))
+    get = _encoders.get
+    for item in term:
+        get(type(item), _encode_python)(item, out)
+    out.append("j")
+
+
+def _encode_improper_list(term, out,
+        # Hack to turn globals into locals
+        len=len, type=type, char_int4_pack=_char_int4_pack):
+    length = len(term)
+    if length > 4294967295:
+        raise ValueError("invalid improper list length: %r" % length)
+    out.append(char_int4_pack('l', length))
+    get = _encoders.get
+    for item in term:
+        get(type(item), _encode_python)(item, out)
+    _encode_term(term.tail, out)
+
+
+def _encode_byte_list(term, out,
+        # Hack to turn globals into locals
+        len=len, str=str, char_int4_pack=_char_int4_pack,
+        char_int2_pack=_char_int2_pack):
+    # bytearray is encoded as a list of small integers, same as a list with
+    # the same items but without checking every item
+    length = len(term)
+    if not term:
+        out.append("j")
+    elif length <= 65535:
+        out.append(char_int2_pack('k', length))
+        out.append(str(term))
+    elif length <= 4294967295:
+        items = bytearray(length * 2)
+        items[::2] = "a" * length
+        items[1::2] = term
+        out.append(char_int4_pack('l', length))
+        out.append(str(items))
+        out.append("j")
+    else:
+        raise ValueError("invalid list length: %r" % length)
+
+
+def _encode_unicode(term, out,
+        # Hack to turn globals into locals
+        len=len, ord=ord, char_int4_pack=_char_int4_pack,
+        char_int2_pack=_char_int2_pack,
+        char_signed_int4_pack=_char_signed_int4_pack,
+        small_integers=_small_integers):
+    length = len(term)
+    if not term:
+        out.append("j")
+        return
+    elif length <= 65535:
+        try:
+            b = term.encode("latin-1")
+        except UnicodeEncodeError:
+            pass
+        else:
+            # All code points are small integers
+            out.append(char_int2_pack('k', length))
+            out.append(b)
+            return
+    elif length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    out.append(char_int4_pack('l', length))
+    append = out.append
+    for c in term:
+        c = ord(c)
+        if c <= 255:
+            append(small_integers[c])
         else:
-            sign = 1
-            term = -term
-
-        bytes = array('B')
-        append = bytes.append
-        while term:
-            append(term & 0xff)
-            term >>= 8
-
-        length = len(bytes)
-        if length <= 255:
-            return char_2bytes_pack('n', length, sign) + bytes.tostring()
-        elif length <= 4294967295:
-            return char_int4_byte_pack('o', length, sign) + bytes.tostring()
+            append(char_signed_int4_pack('b', c))
+    append("j")
+
+
+def _encode_atom(term, out,
+        # Hack to turn globals into locals
+        len=len, cache=_encoded_atoms, max_cached=_MAX_ENCODED_ATOMS,
+        atom_headers=_atom_headers):
+    encoded = cache.get(term)
+    if encoded is None:
+        # Atom length is always less than 256
+        encoded = atom_headers[len(term)] + term
+        if len(cache) < max_cached:
+            cache[term] = encoded
+    out.append(encoded)
+
+
+def _encode_binary(term, out, len=len, char_int4_pack=_char_int4_pack):
+    length = len(term)
+    if length > 4294967295:
+        raise ValueError("invalid binary length: %r" % length)
+    out.append(char_int4_pack('m', length))
+    out.append(term)
+
+
+def _encode_boolean(term, out):
+    if term:
+        out.append("d\0\4true")
+    else:
+        out.append("d\0\5false")
+
+
+def _encode_none(term, out):
+    out.append("d\0\11undefined")
+
+
+def _encode_integer(term, out,
+        # Hack to turn globals into locals
+        len=len, char_signed_int4_pack=_char_signed_int4_pack,
+        char_2bytes_pack=_char_2bytes_pack,
+        char_int4_byte_pack=_char_int4_byte_pack,
+        small_integers=_small_integers):
+    if 0 <= term <= 255:
+        out.append(small_integers[term])
+        return
+    elif -2147483648 <= term <= 2147483647:
+        out.append(char_signed_int4_pack('b', term))
+        return
+
+    if term >= 0:
+        sign = 0
+    else:
+        sign = 1
+        term = -term
+
+    # Hex conversion is done in C and works with all supported Python
+    # versions, unlike long.bit_length() which is new in Python 2.7
+    h = "%x" % term
+    if len(h) & 1:
+        h = "0" + h
+    bytes = h.decode("hex")[::-1]
+
+    length = len(bytes)
+    if length <= 255:
+        out.append(char_2bytes_pack('n', length, sign))
+    elif length <= 4294967295:
+        out.append(char_int4_byte_pack('o', length, sign))
+    else:
         raise ValueError("invalid integer value with length: %r" % length)
-    elif t is float:
-        return char_float_pack('F', term)
-    elif term is None:
-        return "d\0\11undefined"
-    elif t is OpaqueObject:
-        return term.encode()
-    elif t is ImproperList:
-        length = len(term)
-        if length > 4294967295:
-            raise ValueError("invalid improper list length: %r" % length)
-        header = char_int4_pack('l', length)
-        return header + "".join(map(encode_term, term)) + encode_term(term.tail)
+    out.append(bytes)
+
+
+def _encode_float(term, out, char_float_pack=_char_float_pack):
+    out.append(char_float_pack('F', term))
 
+
+def _encode_opaque(term, out):
+    out.append(term.encode())
+
+
+def _encode_python(term, out,
+        # Hack to turn globals into locals
+        dumps=dumps, PICKLE_PROTOCOL=PICKLE_PROTOCOL, python=_python):
     try:
         data = dumps(term, PICKLE_PROTOCOL)
     except:
         raise ValueError("unsupported data type: %s" % type(term))
-    return OpaqueObject(data, python).encode()
+    out.append(OpaqueObject(data, python).encode())
+
+
+# Term encoders by exact type. Types not listed here (including subclasses
+# of the listed types) are pickled as opaque Python objects.
+_encoders = {
+    tuple: _encode_tuple,
+    list: _encode_list,
+    List: _encode_list,
+    ImproperList: _encode_improper_list,
+    unicode: _encode_unicode,
+    Atom: _encode_atom,
+    str: _encode_binary,
+    bool: _encode_boolean,
+    type(None): _encode_none,
+    int: _encode_integer,
+    long: _encode_integer,
+    float: _encode_float,
+    OpaqueObject: _encode_opaque,
+    }
+
+try:
+    _encoders[bytearray] = _encode_byte_list
+except NameError:
+    # bytearray is new in Python 2.6
+    pass
+
+
+def _encode_term(term, out, type=type, encoders=_encoders):
+    encoders.get(type(term), _encode_python)(term, out)
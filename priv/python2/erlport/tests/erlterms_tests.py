@@ -31,7 +31,8 @@ from pickle import dumps
 
 from erlport import erlterms
 from erlport.erlterms import Atom, List, ImproperList, OpaqueObject
-from erlport.erlterms import encode, decode, IncompleteData
+from erlport.erlterms import encode, decode, decode_into, IncompleteData
+from erlport.erlterms import make_encoder
 
 
 class AtomTestCase(unittest.TestCase):
@@ -132,12 +133,24 @@ class OpaqueObjectTestCase(unittest.TestCase):
 
 class DecodeTestCase(unittest.TestCase):
 
+    def test_incomplete_data(self):
+        e = IncompleteData("ab")
+        self.assertEqual("ab", e.data)
+        self.assertEqual("incomplete data: 'ab'", str(e))
+
     def test_decode(self):
         self.assertRaises(IncompleteData, decode, "")
         self.assertRaises(ValueError, decode, "\0")
         self.assertRaises(IncompleteData, decode, "\x83")
         self.assertRaises(ValueError, decode, "\x83z")
 
+    def test_decode_term(self):
+        self.assertRaises(IncompleteData, erlterms.decode_term, "tail", 4)
+        self.assertEqual((Atom("test"), 10),
+            erlterms.decode_term("abcd\0\4testtail", 3))
+        self.assertEqual(((1, 2), 10),
+            erlterms.decode_term("tailh\2a\1a\2", 4))
+
     def test_decode_atom(self):
         self.assertRaises(IncompleteData, decode, "\x83d")
         self.assertRaises(IncompleteData, decode, "\x83d\0")
@@ -146,6 +159,9 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual((Atom(""), "tail"), decode("\x83d\0\0tail"))
         self.assertEqual((Atom("test"), ""), decode("\x83d\0\4test"))
         self.assertEqual((Atom("test"), "tail"), decode("\x83d\0\4testtail"))
+        atom, _ = decode("\x83d\0\4test")
+        self.assertTrue(atom is decode("\x83d\0\4test")[0])
+        self.assertRaises(ValueError, decode, "\x83d\1\0" + "X" * 256)
 
     def test_decode_predefined_atoms(self):
         self.assertEqual((True, ""), decode("\x83d\0\4true"))
@@ -178,6 +194,9 @@ class DecodeTestCase(unittest.TestCase):
         self.assertRaises(IncompleteData, decode, "\x83l\0\0")
         self.assertRaises(IncompleteData, decode, "\x83l\0\0\0")
         self.assertRaises(IncompleteData, decode, "\x83l\0\0\0\0")
+        self.assertRaises(IncompleteData, decode, "\x83l\xff\xff\xff\xffj")
+        self.assertRaises(IncompleteData, decode, "\x83l\0\0\0\5jjjjj")
+        self.assertEqual(([[]] * 5, ""), decode("\x83l\0\0\0\5jjjjjj"))
         # Elang use 'j' tag for empty lists
         self.assertEqual(([], ""), decode("\x83l\0\0\0\0j"))
         self.assertEqual(([], "tail"), decode("\x83l\0\0\0\0jtail"))
@@ -207,6 +226,7 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual((([], []), "tail"), decode("\x83h\2jjtail"))
 
     def test_decode_large_tuple(self):
+        self.assertRaises(IncompleteData, decode, "\x83i\xff\xff\xff\xffj")
         self.assertRaises(IncompleteData, decode, "\x83i")
         self.assertRaises(IncompleteData, decode, "\x83i\0")
         self.assertRaises(IncompleteData, decode, "\x83i\0\0")
@@ -299,6 +319,10 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual((-6618611909121, ""), decode("\x83n\6\1\1\2\3\4\5\6"))
         self.assertEqual((6618611909121, "tail"),
             decode("\x83n\6\0\1\2\3\4\5\6tail"))
+        self.assertEqual((2 ** 1000, ""), decode(encode(2 ** 1000)))
+        self.assertEqual((-2 ** 1000, ""), decode(encode(-2 ** 1000)))
+        self.assertEqual((2 ** 64 - 1, ""), decode(encode(2 ** 64 - 1)))
+        self.assertEqual((-2 ** 63, ""), decode(encode(-2 ** 63)))
 
     def test_decode_big_integer(self):
         self.assertRaises(IncompleteData, decode, "\x83o")
@@ -316,6 +340,8 @@ class DecodeTestCase(unittest.TestCase):
             decode("\x83o\0\0\0\6\1\1\2\3\4\5\6"))
         self.assertEqual((6618611909121, "tail"),
             decode("\x83o\0\0\0\6\0\1\2\3\4\5\6tail"))
+        self.assertEqual((2 ** 2048, ""), decode(encode(2 ** 2048)))
+        self.assertEqual((-2 ** 2048, ""), decode(encode(-2 ** 2048)))
 
     def test_decode_compressed_term(self):
         self.assertRaises(IncompleteData, decode, "\x83P")
@@ -325,10 +351,43 @@ class DecodeTestCase(unittest.TestCase):
         self.assertRaises(IncompleteData, decode, "\x83P\0\0\0\0")
         self.assertRaises(ValueError, decode, "\x83P\0\0\0\x16"
             "\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50")
+        self.assertRaises(ValueError, decode, "\x83P\0\0\0\x18"
+            "\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50")
         self.assertEqual(([100] * 20, ""), decode("\x83P\0\0\0\x17"
             "\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50"))
         self.assertEqual(([100] * 20, "tail"), decode("\x83P\0\0\0\x17"
             "\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50tail"))
+        term = [(Atom("test"), "X" * 1000, 1.5)] * 1000
+        self.assertEqual((term, "tail"), decode(encode(term, True) + "tail"))
+
+    def test_decode_into(self):
+        data = bytearray("tail\x83h\3d\0\4testm\0\0\0\3bink\0\2\1\2tail")
+        self.assertEqual(((Atom("test"), "bin", [1, 2]), 27),
+            decode_into(data, 4))
+        term, pos = decode_into(data, 4, zero_copy=True)
+        self.assertEqual(27, pos)
+        self.assertEqual(buffer, type(term[1]))
+        self.assertEqual("bin", str(term[1]))
+        self.assertEqual(((1, 2), 7), decode_into("\x83h\2a\1a\2tail"))
+        self.assertRaises(IncompleteData, decode_into, data, 31)
+        self.assertRaises(IncompleteData, decode_into, data[:20], 4)
+        self.assertRaises(ValueError, decode_into, data, 0)
+        data = bytearray("tail" + encode([u"x" * 100], compressed=True))
+        self.assertEqual(([List([120] * 100)], len(data)),
+            decode_into(data, 4))
+
+    def test_decode_into_incomplete_data(self):
+        data = bytearray("tail\x83h\2m\0\0\0\1xa")
+        try:
+            decode_into(data, 4, zero_copy=True)
+        except IncompleteData, e:
+            self.assertEqual("\x83h\2m\0\0\0\1xa", e.data)
+            # The buffer can be extended while the exception is alive
+            data += "\1"
+        else:
+            self.fail("IncompleteData expected")
+        self.assertEqual((("x", 1), 15), decode_into(data, 4))
+
 
 class EncodeTestCase(unittest.TestCase):
 
@@ -338,6 +397,11 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual("\x83h\xff" + "h\0" * 255, encode(tuple([()] * 255)))
         self.assertEqual("\x83i\0\0\1\0" + "h\0" * 256,
             encode(tuple([()] * 256)))
+        self.assertEqual("\x83h\x10" + "a\1" * 16, encode((1,) * 16))
+        self.assertEqual("\x83h\x10" + "a\1" * 14 + "b\0\0\1\0a\1",
+            encode((1,) * 14 + (256, 1)))
+        self.assertEqual("\x83h\x10" + "a\1" * 14 + "d\0\4truea\1",
+            encode((1,) * 14 + (True, 1)))
 
     def test_encode_empty_list(self):
         self.assertEqual("\x83j", encode([]))
@@ -352,6 +416,20 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual("\x83l\0\0\0\5jjjjjj", encode([[], [], [], [], []]))
         self.assertEqual("\x83l\0\0\0\5jjjjjj",
             encode(List([List([]), List([]), List([]), List([]), List([])])))
+        self.assertEqual("\x83l\0\1\0\0" + "a\1" * 65536 + "j",
+            encode([1] * 65536))
+        self.assertEqual("\x83l\0\1\0\0" + "a\1" * 65535 + "b\0\0\1\0j",
+            encode([1] * 65535 + [256]))
+
+    def test_encode_byte_list(self):
+        self.assertEqual("\x83j", encode(bytearray()))
+        self.assertEqual("\x83k\0\4test", encode(bytearray("test")))
+        self.assertEqual("\x83k\xff\xff" + "X" * 65535,
+            encode(bytearray("X" * 65535)))
+        self.assertEqual("\x83l\0\1\0\0" + "aX" * 65536 + "j",
+            encode(bytearray("X" * 65536)))
+        self.assertEqual(([1, 2, 255], ""),
+            decode(encode(bytearray([1, 2, 255]))))
 
     def test_encode_improper_list(self):
         self.assertEqual("\x83l\0\0\0\1h\0h\0", encode(ImproperList([()], ())))
@@ -362,6 +440,7 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual("\x83k\0\4test", encode(u"test"))
         self.assertEqual("\x83k\0\2\0\xff", encode(u"\0\xff"))
         self.assertEqual("\x83l\0\0\0\1b\0\0\1\0j", encode(u"\u0100"))
+        self.assertEqual("\x83l\0\0\0\2aab\0\0\1\0j", encode(u"a\u0100"))
         self.assertEqual("\x83l\0\0\0\4b\0\0\4Bb\0\0\x045b\0\0\4Ab\0\0\4Bj",
             encode(u"\u0442\u0435\u0441\u0442"))
         self.assertEqual("\x83l\0\1\0\0" + "aX" * 65536 + "j",
@@ -372,6 +451,21 @@ class EncodeTestCase(unittest.TestCase):
     def test_encode_atom(self):
         self.assertEqual("\x83d\0\0", encode(Atom("")))
         self.assertEqual("\x83d\0\4test", encode(Atom("test")))
+        self.assertEqual("\x83d\0\4test", encode(Atom("test")))
+        # The cache is shared by the module so restore it for other tests
+        encoded_atoms = erlterms._encoded_atoms
+        saved = encoded_atoms.copy()
+        encoded_atoms.clear()
+        try:
+            for i in range(erlterms._MAX_ENCODED_ATOMS + 1):
+                name = "atom%d" % i
+                self.assertEqual("\x83d\0" + chr(len(name)) + name,
+                    encode(Atom(name)))
+            self.assertEqual(erlterms._MAX_ENCODED_ATOMS,
+                len(encoded_atoms))
+        finally:
+            encoded_atoms.clear()
+            encoded_atoms.update(saved)
 
     def test_encode_string(self):
         self.assertEqual("\x83m\0\0\0\0", encode(""))
@@ -437,6 +531,29 @@ class EncodeTestCase(unittest.TestCase):
             "x\x01\xcba``\xe0\xcfB\x03\x00B@\x07\x1c",
             encode([[]] * 15, 1))
 
+    def test_make_encoder(self):
+        call = Atom("call")
+        encode_call = make_encoder((call, Atom, Atom, list))
+        self.assertEqual(encode((call, Atom("m"), Atom("f"), [1, 2])),
+            encode_call(Atom("m"), Atom("f"), [1, 2]))
+        # Arguments of other types are encoded as usual
+        self.assertEqual(encode((call, 1, u"f", (1,))),
+            encode_call(1, u"f", (1,)))
+        encode_reply = make_encoder((Atom("r"), int, object))
+        self.assertEqual(encode((Atom("r"), 1, 2.5)), encode_reply(1, 2.5))
+        self.assertEqual(encode((Atom("r"), 1, set([1]))),
+            encode_reply(1, set([1])))
+        self.assertEqual(encode(((1, (2, [])), u"x")),
+            make_encoder(((int, (int, list)), u"x"))(1, 2, []))
+        self.assertEqual(encode((1,) * 256),
+            make_encoder((1,) * 255 + (int,))(1))
+        # More than 255 placeholders
+        items = tuple(range(300))
+        self.assertEqual(encode(items),
+            make_encoder((int,) * 300)(*items))
+        self.assertEqual(encode(1), make_encoder(int)(1))
+        self.assertEqual(encode(()), make_encoder(())())
+
 def get_suite():
     load = unittest.TestLoader().loadTestsFromTestCase
     suite = unittest.TestSuite()
@@ -54,7 +54,7 @@ class Port(object):
         if struct is None:
             raise ValueError("invalid packet size value: %s" % (packet,))
         self.__pack = struct.pack
-        self.__unpack = struct.unpack
+        self.__unpack_from = struct.unpack_from
         self.packet = packet
         self.compressed = compressed
 
@@ -88,7 +88,7 @@ class Port(object):
             buffer = self.__buffer
             while len(buffer) < packet:
                 buffer += self._read_data()
-            length = self.__unpack(buffer[:packet])[0] + packet
+            length = self.__unpack_from(buffer)[0] + packet
             while len(buffer) < length:
                 buffer += self._read_data()
             term, self.__buffer = decode(buffer[packet:])
@@ -34,9 +34,10 @@ See Erlang External Term Format for details:
 __author__ = "Dmitry Vasiliev <dima@hlabs.org>"
 
 from struct import Struct
-from array import array
 from zlib import decompressobj, compress
+from itertools import repeat
 from pickle import loads, dumps
+from types import FunctionType
 
 
 # It seems protocol version 2 is supported by all Python versions
@@ -47,8 +48,13 @@ class IncompleteData(ValueError):
     """Need more data."""
 
     def __init__(self, data):
+        # Incomplete data is a normal condition when decoding a stream and
+        # the data can be large so the message is formatted only on demand
         self.data = data
-        super(IncompleteData, self).__init__("incomplete data: %r" % (data,))
+        super(IncompleteData, self).__init__(data)
+
+    def __str__(self):
+        return "incomplete data: %r" % (self.data,)
 
 
 class Atom(bytes):
@@ -157,12 +163,16 @@ class OpaqueObject(object):
 
 _python = Atom(b"python")
 
-_int4_unpack = Struct(b">I").unpack
-_int2_unpack = Struct(b">H").unpack
-_signed_int4_unpack = Struct(b">i").unpack
-_float_unpack = Struct(b">d").unpack
-_double_bytes_unpack = Struct(b"BB").unpack
-_int4_byte_unpack = Struct(b">IB").unpack
+_int4_unpack_from = Struct(b">I").unpack_from
+_int2_unpack_from = Struct(b">H").unpack_from
+_signed_int4_unpack_from = Struct(b">i").unpack_from
+_float_unpack_from = Struct(b">d").unpack_from
+_double_bytes_unpack_from = Struct(b"BB").unpack_from
+_int4_byte_unpack_from = Struct(b">IB").unpack_from
+
+# Decoded atoms by name. Atom instances are interned by the Atom class anyway
+# so the cache only saves the constructor call on every decoded atom.
+_decoded_atoms = {b"true": True, b"false": False, b"undefined": None}
 
 
 def decode(string):
@@ -172,139 +182,366 @@ def decode(string):
     if string[0] != 131:
         raise ValueError("unknown protocol version: %r" % string[0])
     if string[1:2] == b'P':
-        # compressed term
-        if len(string) < 16:
-            raise IncompleteData(string)
-        d = decompressobj()
-        term_string = d.decompress(string[6:]) + d.flush()
-        uncompressed_size, = _int4_unpack(string[2:6])
-        if len(term_string) != uncompressed_size:
-            raise ValueError(
-                "invalid compressed tag, "
-                "%d bytes but got %d" % (uncompressed_size, len(term_string)))
-        # tail data returned by decode_term() can be simple ignored
-        term, _tail = decode_term(term_string)
-        return term, d.unused_data
-    return decode_term(string[1:])
-
-
-def decode_term(string,
+        # compressed term, tail data is what left after the zlib stream
+        return _decode_compressed(string, 0)
+    term, pos = decode_term(string, 1)
+    return term, string[pos:]
+
+
+def decode_into(data, offset=0, zero_copy=False):
+    """Decode Erlang external term from a buffer at the given offset.
+
+    The data can be any object supporting the buffer protocol (bytes,
+    bytearray, memoryview, etc.) and is not copied, so the same buffer can be
+    reused for incoming messages. Returns a tuple of the decoded term and the
+    offset of the first byte after the term.
+
+    If zero_copy is true binaries are returned as memoryview slices of the
+    data (except for compressed terms). A bytearray can't be resized while
+    any of them is alive, so copy the binaries which are kept before reusing
+    the buffer.
+
+    On IncompleteData the exception data is a copy of the data starting at
+    the offset so the buffer can be extended and decoded again.
+    """
+    string = memoryview(data)
+    if string.format != "B":
+        # Offsets are in bytes whatever the item size of the buffer is
+        string = string.cast("B")
+    try:
+        if len(string) <= offset:
+            raise IncompleteData(b"")
+        if string[offset] != 131:
+            raise ValueError("unknown protocol version: %r" % string[offset])
+        if string[offset + 1:offset + 2] == b'P':
+            term, tail = _decode_compressed(string, offset)
+            return term, len(string) - len(tail)
+        if zero_copy:
+            return _decode_zero_copy_term(string, offset + 1)
+        return _decode_buffer_term(string, offset + 1)
+    except IncompleteData:
+        # The exception and its traceback refer to views of the data which
+        # prevent a bytearray from being resized, so a copy is raised
+        # instead outside of the except clause
+        incomplete = string[offset:].tobytes()
+    finally:
+        string.release()
+    raise IncompleteData(incomplete)
+
+
+def _decode_compressed(string, pos,
         # Hack to turn globals into locals
-        len=len, ord=ord, tuple=tuple, float=float, array=array,
-        int4_unpack=_int4_unpack, int2_unpack=_int2_unpack,
-        signed_int4_unpack=_signed_int4_unpack, float_unpack=_float_unpack,
-        double_bytes_unpack=_double_bytes_unpack,
-        int4_byte_unpack=_int4_byte_unpack, Atom=Atom,
-        opaque=OpaqueObject.marker, decode_opaque=OpaqueObject.decode):
-    if not string:
-        raise IncompleteData(string)
-    tag = string[0]
-    if tag == 100:
-        # ATOM_EXT
-        ln = len(string)
-        if ln < 3:
-            raise IncompleteData(string)
-        length = int2_unpack(string[1:3])[0] + 3
-        if ln < length:
-            raise IncompleteData(string)
-        name = string[3:length]
-        if name == b"true":
-            return True, string[length:]
-        elif name == b"false":
-            return False, string[length:]
-        elif name == b"undefined":
-            return None, string[length:]
-        return Atom(name), string[length:]
-    elif tag == 106:
-        # NIL_EXT
-        return List(), string[1:]
-    elif tag == 107:
-        # STRING_EXT
-        ln = len(string)
-        if ln < 3:
-            raise IncompleteData(string)
-        length = int2_unpack(string[1:3])[0] + 3
-        if ln < length:
-            raise IncompleteData(string)
-        return List(string[3:length]), string[length:]
-    elif tag in b"lhi":
-        # LIST_EXT, SMALL_TUPLE_EXT, LARGE_TUPLE_EXT
-        if tag == 104:
-            if len(string) < 2:
-                raise IncompleteData(string)
-            length = string[1]
-            tail = string[2:]
-        else:
-            if len(string) < 5:
-                raise IncompleteData(string)
-            length, = int4_unpack(string[1:5])
-            tail = string[5:]
+        len=len, int4_unpack_from=_int4_unpack_from):
+    if len(string) < pos + 16:
+        raise IncompleteData(string[pos:])
+    uncompressed_size, = int4_unpack_from(string, pos + 2)
+    d = decompressobj()
+    # Decompress from a view to not copy the compressed data. Output is
+    # limited to the declared size (plus one byte to detect a mismatch)
+    # so the peak memory is bounded by the header and not by whatever
+    # the compressed stream expands to.
+    term_string = d.decompress(memoryview(string)[pos + 6:],
+        uncompressed_size + 1)
+    if len(term_string) > uncompressed_size:
+        raise ValueError(
+            "invalid compressed tag, "
+            "%d bytes but got more" % uncompressed_size)
+    # All input is consumed at this point so flush() can only return
+    # the last few bytes of the stream
+    flushed = d.flush()
+    if flushed:
+        term_string += flushed
+    if len(term_string) != uncompressed_size:
+        raise ValueError(
+            "invalid compressed tag, "
+            "%d bytes but got %d" % (uncompressed_size, len(term_string)))
+    # tail data returned by decode_term() can be simple ignored
+    term, _pos = decode_term(term_string, 0)
+    return term, d.unused_data
+
+
+def _decode_atom(string, pos,
+        # Hack to turn globals into locals
+        len=len, int2_unpack_from=_int2_unpack_from, Atom=Atom,
+        atoms=_decoded_atoms):
+    # ATOM_EXT
+    ln = len(string)
+    if ln < pos + 3:
+        raise IncompleteData(string[pos:])
+    end = int2_unpack_from(string, pos + 1)[0] + pos + 3
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    name = string[pos + 3:end]
+    try:
+        return atoms[name], end
+    except KeyError:
+        atom = atoms[name] = Atom(name)
+        return atom, end
+
+
+def _decode_buffer_atom(string, pos,
+        # Hack to turn globals into locals
+        len=len, int2_unpack_from=_int2_unpack_from, Atom=Atom,
+        atoms=_decoded_atoms, bytes=bytes):
+    # ATOM_EXT from a memoryview which slices can't be dictionary keys
+    ln = len(string)
+    if ln < pos + 3:
+        raise IncompleteData(string[pos:])
+    end = int2_unpack_from(string, pos + 1)[0] + pos + 3
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    name = bytes(string[pos + 3:end])
+    try:
+        return atoms[name], end
+    except KeyError:
+        atom = atoms[name] = Atom(name)
+        return atom, end
+
+
+def _decode_nil(string, pos, List=List):
+    # NIL_EXT
+    return List(), pos + 1
+
+
+def _decode_string(string, pos,
+        # Hack to turn globals into locals
+        len=len, int2_unpack_from=_int2_unpack_from, List=List):
+    # STRING_EXT
+    ln = len(string)
+    if ln < pos + 3:
+        raise IncompleteData(string[pos:])
+    end = int2_unpack_from(string, pos + 1)[0] + pos + 3
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    return List(string[pos + 3:end]), end
+
+
+def _decode_list(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from, List=List,
+        ImproperList=ImproperList, repeat=repeat, range=range):
+    # LIST_EXT
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    length, = int4_unpack_from(string, pos + 1)
+    i = pos + 5
+    # Every element and the tail take at least one byte
+    if ln <= i + length:
+        raise IncompleteData(string[pos:])
+    _decode_term = decode_term
+    if length <= 4:
+        # Appending is faster for short lists
         lst = List()
         append = lst.append
-        _decode_term = decode_term
         while length > 0:
-            term, tail = _decode_term(tail)
+            term, i = _decode_term(string, i)
             append(term)
             length -= 1
-        if tag == 108:
-            if not tail:
-                raise IncompleteData(string)
-            if tail[0] != 106:
-                improper_tail, tail = _decode_term(tail)
-                return ImproperList(lst, improper_tail), tail
-            return lst, tail[1:]
-        if len(lst) == 3 and lst[0] == opaque:
-            return decode_opaque(lst[2], lst[1]), tail
-        return tuple(lst), tail
-    elif tag == 97:
-        # SMALL_INTEGER_EXT
-        if len(string) < 2:
-            raise IncompleteData(string)
-        return string[1], string[2:]
-    elif tag == 98:
-        # INTEGER_EXT
-        if len(string) < 5:
-            raise IncompleteData(string)
-        i, = signed_int4_unpack(string[1:5])
-        return i, string[5:]
-    elif tag == 109:
-        # BINARY_EXT
-        ln = len(string)
-        if ln < 5:
-            raise IncompleteData(string)
-        length = int4_unpack(string[1:5])[0] + 5
-        if ln < length:
-            raise IncompleteData(string)
-        return string[5:length], string[length:]
-    elif tag == 70:
-        # NEW_FLOAT_EXT
-        if len(string) < 9:
-            raise IncompleteData(string)
-        f, = float_unpack(string[1:9])
-        return f, string[9:]
-    elif tag in b"no":
-        # SMALL_BIG_EXT, LARGE_BIG_EXT
-        if tag == 110:
-            if len(string) < 3:
-                raise IncompleteData(string)
-            length, sign = double_bytes_unpack(string[1:3])
-            tail = string[3:]
-        else:
-            if len(string) < 6:
-                raise IncompleteData(string)
-            length, sign = int4_byte_unpack(string[1:6])
-            tail = string[6:]
-        if len(tail) < length:
-            raise IncompleteData(string)
-        n = 0
-        if length:
-            for i in reversed(tail[:length]):
-                n = (n << 8) | i
-            if sign:
-                n = -n
-        return n, tail[length:]
-
-    raise ValueError("unsupported data: %r" % (string,))
+    else:
+        lst = List(repeat(None, length))
+        for n in range(length):
+            lst[n], i = _decode_term(string, i)
+    if ln <= i:
+        raise IncompleteData(string[pos:])
+    if string[i] != 106:
+        improper_tail, i = _decode_term(string, i)
+        return ImproperList(lst, improper_tail), i
+    return lst, i + 1
+
+
+def _decode_small_tuple(string, pos, len=len):
+    # SMALL_TUPLE_EXT
+    if len(string) < pos + 2:
+        raise IncompleteData(string[pos:])
+    return _decode_tuple(string, pos + 2, string[pos + 1])
+
+
+def _decode_large_tuple(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from):
+    # LARGE_TUPLE_EXT
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    arity, = int4_unpack_from(string, pos + 1)
+    # Every element takes at least one byte
+    if ln < pos + 5 + arity:
+        raise IncompleteData(string[pos:])
+    return _decode_tuple(string, pos + 5, arity)
+
+
+def _decode_tuple(string, pos, arity,
+        # Hack to turn globals into locals
+        len=len, tuple=tuple, range=range, opaque=OpaqueObject.marker,
+        decode_opaque=OpaqueObject.decode, memoryview=memoryview):
+    _decode_term = decode_term
+    if arity <= 4:
+        # Appending is faster for small tuples
+        lst = []
+        append = lst.append
+        while arity > 0:
+            term, pos = _decode_term(string, pos)
+            append(term)
+            arity -= 1
+    else:
+        lst = [None] * arity
+        for n in range(arity):
+            lst[n], pos = _decode_term(string, pos)
+    if len(lst) == 3 and lst[0] == opaque:
+        data = lst[2]
+        if type(data) is memoryview:
+            # decode_into(..., zero_copy=True)
+            data = data.tobytes()
+        return decode_opaque(data, lst[1]), pos
+    return tuple(lst), pos
+
+
+def _decode_small_integer(string, pos, len=len):
+    # SMALL_INTEGER_EXT
+    if len(string) < pos + 2:
+        raise IncompleteData(string[pos:])
+    return string[pos + 1], pos + 2
+
+
+def _decode_integer(string, pos,
+        # Hack to turn globals into locals
+        len=len, signed_int4_unpack_from=_signed_int4_unpack_from):
+    # INTEGER_EXT
+    if len(string) < pos + 5:
+        raise IncompleteData(string[pos:])
+    i, = signed_int4_unpack_from(string, pos + 1)
+    return i, pos + 5
+
+
+def _decode_binary(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from):
+    # BINARY_EXT
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    end = int4_unpack_from(string, pos + 1)[0] + pos + 5
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    return string[pos + 5:end], end
+
+
+def _decode_buffer_binary(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from, bytes=bytes):
+    # BINARY_EXT from a memoryview, copied so it outlives the buffer
+    ln = len(string)
+    if ln < pos + 5:
+        raise IncompleteData(string[pos:])
+    end = int4_unpack_from(string, pos + 1)[0] + pos + 5
+    if ln < end:
+        raise IncompleteData(string[pos:])
+    return bytes(string[pos + 5:end]), end
+
+
+def _decode_float(string, pos,
+        # Hack to turn globals into locals
+        len=len, float_unpack_from=_float_unpack_from):
+    # NEW_FLOAT_EXT
+    if len(string) < pos + 9:
+        raise IncompleteData(string[pos:])
+    f, = float_unpack_from(string, pos + 1)
+    return f, pos + 9
+
+
+def _decode_small_big_integer(string, pos,
+        # Hack to turn globals into locals
+        len=len, double_bytes_unpack_from=_double_bytes_unpack_from):
+    # SMALL_BIG_EXT
+    if len(string) < pos + 3:
+        raise IncompleteData(string[pos:])
+    length, sign = double_bytes_unpack_from(string, pos + 1)
+    return _decode_big_integer(string, pos, pos + 3, length, sign)
+
+
+def _decode_large_big_integer(string, pos,
+        # Hack to turn globals into locals
+        len=len, int4_byte_unpack_from=_int4_byte_unpack_from):
+    # LARGE_BIG_EXT
+    if len(string) < pos + 6:
+        raise IncompleteData(string[pos:])
+    length, sign = int4_byte_unpack_from(string, pos + 1)
+    return _decode_big_integer(string, pos, pos + 6, length, sign)
+
+
+def _decode_big_integer(string, pos, start, length, sign,
+        # Hack to turn globals into locals
+        len=len, int_from_bytes=int.from_bytes):
+    end = start + length
+    if len(string) < end:
+        raise IncompleteData(string[pos:])
+    n = int_from_bytes(string[start:end], "little")
+    if sign:
+        n = -n
+    return n, end
+
+
+# Term decoders indexed by tag byte
+_decoders = [None] * 256
+_decoders[100] = _decode_atom
+_decoders[106] = _decode_nil
+_decoders[107] = _decode_string
+_decoders[108] = _decode_list
+_decoders[104] = _decode_small_tuple
+_decoders[105] = _decode_large_tuple
+_decoders[97] = _decode_small_integer
+_decoders[98] = _decode_integer
+_decoders[109] = _decode_binary
+_decoders[70] = _decode_float
+_decoders[110] = _decode_small_big_integer
+_decoders[111] = _decode_large_big_integer
+
+
+def decode_term(string, pos,
+        # Hack to turn globals into locals
+        len=len, decoders=_decoders):
+    """Decode Erlang term starting at the given position of the string.
+
+    Returns a tuple of the decoded term and the position of the first byte
+    after the term.
+    """
+    if len(string) <= pos:
+        raise IncompleteData(string[pos:])
+    decoder = decoders[string[pos]]
+    if decoder is None:
+        # bytes() for memoryview data from decode_into()
+        raise ValueError("unsupported data: %r" % (bytes(string[pos:]),))
+    return decoder(string, pos)
+
+
+def _make_decode_term(replaced, FunctionType=FunctionType):
+    """Make a copy of decode_term() with some of the tag decoders replaced.
+
+    List and tuple decoders are copied too with the new decode_term() in
+    their globals so nested terms are decoded by the same decoders without
+    passing them around on every call.
+    """
+    namespace = dict(globals())
+    decoders = dict(replaced)
+    for function in (_decode_list, _decode_small_tuple, _decode_large_tuple,
+            _decode_tuple):
+        decoders[function] = namespace[function.__name__] = FunctionType(
+            function.__code__, namespace, function.__name__,
+            function.__defaults__)
+    function = namespace["decode_term"] = FunctionType(
+        decode_term.__code__, namespace, "decode_term",
+        (len, [decoders.get(d, d) for d in _decoders]))
+    return function
+
+# decode_term() versions for memoryview data used by decode_into()
+_decode_buffer_term = _make_decode_term({
+    _decode_atom: _decode_buffer_atom,
+    _decode_binary: _decode_buffer_binary,
+    })
+_decode_zero_copy_term = _make_decode_term({
+    _decode_atom: _decode_buffer_atom,
+    })
 
 _int4_pack = Struct(b">I").pack
 _char_int4_pack = Struct(b">cI").pack
@@ -314,9 +551,26 @@ _char_float_pack = Struct(b">cd").pack
 _char_2bytes_pack = Struct(b"cBB").pack
 _char_int4_byte_pack = Struct(b">cIB").pack
 
+# Encoded atoms by atom. The cache size is limited so applications which
+# create a lot of distinct atoms don't fill it with rarely used ones.
+_encoded_atoms = {}
+_MAX_ENCODED_ATOMS = 1024
+
+# Precomputed SMALL_INTEGER_EXT terms and SMALL_TUPLE_EXT/ATOM_EXT headers
+# indexed by value/arity/length. Indexing is faster than Struct.pack() or
+# building the few bytes by hand.
+_small_integers = [bytes((97, i)) for i in range(256)]
+_small_tuple_headers = [bytes((104, i)) for i in range(256)]
+_atom_headers = [bytes((100, 0, i)) for i in range(256)]
+
+# Minimal number of items in a tuple to try to encode them all at once as
+# small integers
+_MIN_BATCHED_ITEMS = 16
+
 def encode(term, compressed=False):
     """Encode Erlang external term."""
-    encoded_term = encode_term(term)
+    out = bytearray(b"\x83")
+    _encode_term(term, out)
     # False and 0 do not attempt compression.
     if compressed:
         if compressed is True:
@@ -324,103 +578,340 @@ def encode(term, compressed=False):
             compressed = 6
         elif compressed < 0 or compressed > 9:
             raise ValueError("invalid compression level: %r" % (compressed,))
-        zlib_term = compress(encoded_term, compressed)
-        ln = len(encoded_term)
+        zlib_term = compress(memoryview(out)[1:], compressed)
+        ln = len(out) - 1
         if len(zlib_term) + 5 <= ln:
             # Compressed term should be smaller
             return b"\x83P" + _int4_pack(ln) + zlib_term
-    return b"\x83" + encoded_term
+    return bytes(out)
+
+
+def encode_term(term):
+    """Encode Erlang term without the protocol version byte."""
+    out = bytearray()
+    _encode_term(term, out)
+    return bytes(out)
+
+
+def make_encoder(template):
+    """Make a function to encode terms of the same shape as the template.
+
+    Tuples in the template are followed recursively, types are placeholders
+    for the function arguments (in the same order) and all other values are
+    constants which are encoded only once. The function returns the same
+    data as encode() of the whole uncompressed term:
+
+        encode_call = make_encoder((Atom(b"call"), Atom, Atom, list))
+        data = encode_call(Atom(b"module"), Atom(b"function"), [1, 2, 3])
+
+    Arguments whose type is not exactly the placeholder type are encoded as
+    by encode(). The returned function should be kept and reused since
+    making it is much slower than encoding a term.
+    """
+    parts = [b"\x83"]
+    _split_template(template, parts)
+    # Generate straight-line code with the encoders for the placeholder
+    # types called directly instead of looking them up for every term
+    names = {"bytearray": bytearray, "bytes": bytes, "type": type,
+        "_encode_term": _encode_term}
+    args = []
+    lines = []
+    for n, part in enumerate(parts):
+        if type(part) is bytes:
+            names["c%d" % n] = part
+            if lines:
+                lines.append("out += c%d" % n)
+            else:
+                lines.append("out = bytearray(c%d)" % n)
+            continue
+        arg = "a%d" % len(args)
+        args.append(arg)
+        encoder = _encoders.get(part)
+        if encoder is None:
+            lines.append("_encode_term(%s, out)" % arg)
+        else:
+            names["t%d" % n] = part
+            names["e%d" % n] = encoder
+            lines.append("if type(%s) is t%d:" % (arg, n))
+            lines.append("    e%d(%s, out)" % (n, arg))
+            lines.append("else:")
+            lines.append("    _encode_term(%s, out)" % arg)
+    lines.append("return bytes(out)")
+    params = ", ".join(args)
+    if len(args) > 255:
+        # Python before 3.7 doesn't allow more than 255 arguments
+        lines.insert(0, "%s, = args" % params)
+        params = "*args"
+    # Constants and encoders are assigned to local variables of the outer
+    # function to make them closure variables which are faster than globals
+    source = ("def make(names):\n%s\n    def encoder(%s):\n%s\n"
+        "    return encoder" % (
+        "\n".join("    %s = names[%r]" % (name, name) for name in names),
+        params, "\n".join("        " + line for line in lines)))
+    namespace = {}
+    exec(source, namespace)
+    return namespace["make"](names)
+
+
+def _split_template(template, parts,
+        # Hack to turn globals into locals
+        isinstance=isinstance, type=type, len=len, bytes=bytes,
+        char_int4_pack=_char_int4_pack,
+        small_tuple_headers=_small_tuple_headers):
+    # Append encoded constants and placeholder types of the template to the
+    # parts list merging consecutive constants
+    if isinstance(template, type):
+        parts.append(template)
+        return
+    is_tuple = type(template) is tuple
+    if is_tuple:
+        arity = len(template)
+        if arity < 256:
+            data = small_tuple_headers[arity]
+        else:
+            data = char_int4_pack(b"i", arity)
+    else:
+        data = encode_term(template)
+    if type(parts[-1]) is bytes:
+        parts[-1] += data
+    else:
+        parts.append(data)
+    if is_tuple:
+        for item in template:
+            _split_template(item, parts)
+
+
+def _encode_tuple(term, out,
+        # Hack to turn globals into locals
+        len=len, type=type, map=map, int=int, bytes=bytes,
+        char_int4_pack=_char_int4_pack,
+        small_tuple_headers=_small_tuple_headers,
+        min_batched=_MIN_BATCHED_ITEMS, int_types=frozenset((int,))):
+    arity = len(term)
+    if arity <= 255:
+        out += small_tuple_headers[arity]
+    elif arity <= 4294967295:
+        out += char_int4_pack(b'i', arity)
+    else:
+        raise ValueError("invalid tuple arity: %r" % arity)
+    if (arity >= min_batched and type(term[0]) is int
+            and type(term[-1]) is int
+            and int_types.issuperset(map(type, term))):
+        # All items are integers, if they are also small integers encode
+        # them all at once
+        try:
+            b = bytes(term)
+        except ValueError:
+            pass
+        else:
+            items = bytearray(arity * 2)
+            items[::2] = b"a" * arity
+            items[1::2] = b
+            out += items
+            return
+    get = _encoders.get
+    for item in term:
+        get(type(item), _encode_python)(item, out)
 
 
-def encode_term(term,
+def _encode_list(term, out,
         # Hack to turn globals into locals
-        tuple=tuple, len=len, list=list, int=int, type=type, array=array,
-        str=str, Atom=Atom, bytes=bytes, map=map, float=float, dict=dict,
-        true=True, false=False, dumps=dumps, PICKLE_PROTOCOL=PICKLE_PROTOCOL,
-        OpaqueObject=OpaqueObject, List=List, ImproperList=ImproperList,
+        len=len, type=type, map=map, int=int, bytes=bytes,
         char_int4_pack=_char_int4_pack, char_int2_pack=_char_int2_pack,
-        char_signed_int4_pack=_char_signed_int4_pack,
-        char_float_pack=_char_float_pack, char_2bytes_pack=_char_2bytes_pack,
-        char_int4_byte_pack=_char_int4_byte_pack, python=_python):
-    t = type(term)
-    if t is tuple:
-        arity = len(term)
-        if arity <= 255:
-            header = b"h" + bytes((arity,))
-        elif arity <= 4294967295:
-            header = char_int4_pack(b'i', arity)
+        int_types=frozenset((int,))):
+    length = len(term)
+    if not term:
+        out.append(106)
+        return
+    elif length <= 65535:
+        try:
+            b = bytes(term)
+        except (ValueError, TypeError):
+            pass
         else:
-            raise ValueError("invalid tuple arity: %r" % arity)
-        return header + b"".join(map(encode_term, term))
-    elif t is list or t is List:
-        length = len(term)
-        if not term:
-            return b"j"
-        elif length <= 65535:
-            try:
-                b = bytes(term)
-            except (ValueError, TypeError):
-                pass
-            else:
-                return char_int2_pack(b'k', length) + b
-        elif length > 4294967295:
-            raise ValueError("invalid list length: %r" % length)
-        return (char_int4_pack(b'l', length)
-            + b"".join(map(encode_term, term)) + b"j")
-    elif t is str:
-        return encode_term(list(map(ord, term)))
-    elif t is Atom:
-        return char_int2_pack(b"d", len(term)) + term
-    elif t is bytes:
-        length = len(term)
-        if length > 4294967295:
-            raise ValueError("invalid binary length: %r" % length)
-        return char_int4_pack(b"m", length) + term
-    # Must be before int type
-    elif term is true:
-        return b"d\0\4true"
-    elif term is false:
-        return b"d\0\5false"
-    elif t is int:
-        if 0 <= term <= 255:
-            return b"a" + bytes((term,))
-        elif -2147483648 <= term <= 2147483647:
-            return char_signed_int4_pack(b'b', term)
-
-        if term >= 0:
-            sign = 0
+            out += char_int2_pack(b'k', length)
+            out += b
+            return
+    elif length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    elif (type(term[0]) is int and type(term[-1]) is int
+            and int_types.issuperset(map(type, term))):
+        # Too long for STRING_EXT but if all items are small integers they
+        # still can be encoded all at once
+        try:
+            b = bytes(term)
+        except ValueError:
+            pass
+        else:
+            _encode_byte_list(b, out)
+            return
+    out += char_int4_pack(b'l', length)
+    get = _encoders.get
+    for item in term:
+        get(type(item), _encode_python)(item, out)
+    out.append(106)
+
+
+def _encode_improper_list(term, out,
+        # Hack to turn globals into locals
+        len=len, type=type, char_int4_pack=_char_int4_pack):
+    length = len(term)
+    if length > 4294967295:
+        raise ValueError("invalid improper list length: %r" % length)
+    out += char_int4_pack(b"l", length)
+    get = _encoders.get
+    for item in term:
+        get(type(item), _encode_python)(item, out)
+    _encode_term(term.tail, out)
+
+
+def _encode_byte_list(term, out,
+        # Hack to turn globals into locals
+        len=len, bytes=bytes, char_int4_pack=_char_int4_pack,
+        char_int2_pack=_char_int2_pack):
+    # bytearray (or bytes from _encode_str()) is encoded as a list of small
+    # integers, same as a list with the same items but without checking
+    # every item
+    length = len(term)
+    if not term:
+        out.append(106)
+    elif length <= 65535:
+        out += char_int2_pack(b'k', length)
+        out += term
+    elif length <= 4294967295:
+        items = bytearray(length * 2)
+        items[::2] = b"a" * length
+        items[1::2] = term
+        out += char_int4_pack(b'l', length)
+        out += items
+        out.append(106)
+    else:
+        raise ValueError("invalid list length: %r" % length)
+
+
+def _encode_str(term, out,
+        # Hack to turn globals into locals
+        len=len, ord=ord, char_int4_pack=_char_int4_pack,
+        char_signed_int4_pack=_char_signed_int4_pack,
+        small_integers=_small_integers):
+    try:
+        b = term.encode("latin-1")
+    except UnicodeEncodeError:
+        pass
+    else:
+        # All code points are small integers
+        _encode_byte_list(b, out)
+        return
+    length = len(term)
+    if length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    out += char_int4_pack(b'l', length)
+    for c in term:
+        c = ord(c)
+        if c <= 255:
+            out += small_integers[c]
         else:
-            sign = 1
-            term = -term
-
-        b = bytearray()
-        append = b.append
-        while term:
-            append(term & 0xff)
-            term >>= 8
-
-        length = len(b)
-        if length <= 255:
-            return char_2bytes_pack(b"n", length, sign) + b
-        elif length <= 4294967295:
-            return char_int4_byte_pack(b"o", length, sign) + b
+            out += char_signed_int4_pack(b'b', c)
+    out.append(106)
+
+
+def _encode_atom(term, out,
+        # Hack to turn globals into locals
+        len=len, cache=_encoded_atoms, max_cached=_MAX_ENCODED_ATOMS,
+        atom_headers=_atom_headers):
+    encoded = cache.get(term)
+    if encoded is None:
+        # Atom length is always less than 256
+        encoded = atom_headers[len(term)] + term
+        if len(cache) < max_cached:
+            cache[term] = encoded
+    out += encoded
+
+
+def _encode_binary(term, out, len=len, char_int4_pack=_char_int4_pack):
+    length = len(term)
+    if length > 4294967295:
+        raise ValueError("invalid binary length: %r" % length)
+    out += char_int4_pack(b"m", length)
+    out += term
+
+
+def _encode_boolean(term, out):
+    if term:
+        out += b"d\0\4true"
+    else:
+        out += b"d\0\5false"
+
+
+def _encode_none(term, out):
+    out += b"d\0\11undefined"
+
+
+def _encode_integer(term, out,
+        # Hack to turn globals into locals
+        char_signed_int4_pack=_char_signed_int4_pack,
+        char_2bytes_pack=_char_2bytes_pack,
+        char_int4_byte_pack=_char_int4_byte_pack,
+        small_integers=_small_integers):
+    if 0 <= term <= 255:
+        out += small_integers[term]
+        return
+    elif -2147483648 <= term <= 2147483647:
+        out += char_signed_int4_pack(b'b', term)
+        return
+
+    if term >= 0:
+        sign = 0
+    else:
+        sign = 1
+        term = -term
+
+    length = (term.bit_length() + 7) >> 3
+    if length <= 255:
+        out += char_2bytes_pack(b"n", length, sign)
+    elif length <= 4294967295:
+        out += char_int4_byte_pack(b"o", length, sign)
+    else:
         raise ValueError("invalid integer value with length: %r" % length)
-    elif t is float:
-        return char_float_pack(b"F", term)
-    elif term is None:
-        return b"d\0\11undefined"
-    elif t is OpaqueObject:
-        return term.encode()
-    elif t is ImproperList:
-        length = len(term)
-        if length > 4294967295:
-            raise ValueError("invalid improper list length: %r" % length)
-        header = char_int4_pack(b"l", length)
-        return (header + b"".join(map(encode_term, term))
-            + encode_term(term.tail))
+    out += term.to_bytes(length, "little")
+
+
+def _encode_float(term, out, char_float_pack=_char_float_pack):
+    out += char_float_pack(b"F", term)
 
+
+def _encode_opaque(term, out):
+    out += term.encode()
+
+
+def _encode_python(term, out,
+        # Hack to turn globals into locals
+        dumps=dumps, PICKLE_PROTOCOL=PICKLE_PROTOCOL, python=_python):
     try:
         data = dumps(term, PICKLE_PROTOCOL)
     except:
         raise ValueError("unsupported data type: %s" % type(term))
-    return OpaqueObject(data, python).encode()
+    out += OpaqueObject(data, python).encode()
+
+
+# Term encoders by exact type. Types not listed here (including subclasses
+# of the listed types) are pickled as opaque Python objects.
+_encoders = {
+    tuple: _encode_tuple,
+    list: _encode_list,
+    List: _encode_list,
+    ImproperList: _encode_improper_list,
+    bytearray: _encode_byte_list,
+    str: _encode_str,
+    Atom: _encode_atom,
+    bytes: _encode_binary,
+    bool: _encode_boolean,
+    type(None): _encode_none,
+    int: _encode_integer,
+    float: _encode_float,
+    OpaqueObject: _encode_opaque,
+    }
+
+
+def _encode_term(term, out, type=type, encoders=_encoders):
+    encoders.get(type(term), _encode_python)(term, out)
@@ -28,10 +28,12 @@
 import unittest
 
 from pickle import dumps
+from array import array
 
 from erlport import erlterms
 from erlport.erlterms import Atom, List, ImproperList, OpaqueObject
-from erlport.erlterms import encode, decode, IncompleteData
+from erlport.erlterms import encode, decode, decode_into, IncompleteData
+from erlport.erlterms import make_encoder
 
 
 class AtomTestCase(unittest.TestCase):
@@ -132,12 +134,24 @@ class OpaqueObjectTestCase(unittest.TestCase):
 
 class DecodeTestCase(unittest.TestCase):
 
+    def test_incomplete_data(self):
+        e = IncompleteData(b"ab")
+        self.assertEqual(b"ab", e.data)
+        self.assertEqual("incomplete data: b'ab'", str(e))
+
     def test_decode(self):
         self.assertRaises(IncompleteData, decode, b"")
         self.assertRaises(ValueError, decode, b"\0")
         self.assertRaises(IncompleteData, decode, b"\x83")
         self.assertRaises(ValueError, decode, b"\x83z")
 
+    def test_decode_term(self):
+        self.assertRaises(IncompleteData, erlterms.decode_term, b"tail", 4)
+        self.assertEqual((Atom(b"test"), 10),
+            erlterms.decode_term(b"abcd\0\4testtail", 3))
+        self.assertEqual(((1, 2), 10),
+            erlterms.decode_term(b"tailh\2a\1a\2", 4))
+
     def test_decode_atom(self):
         self.assertRaises(IncompleteData, decode, b"\x83d")
         self.assertRaises(IncompleteData, decode, b"\x83d\0")
@@ -146,6 +160,9 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual((Atom(b""), b"tail"), decode(b"\x83d\0\0tail"))
         self.assertEqual((Atom(b"test"), b""), decode(b"\x83d\0\4test"))
         self.assertEqual((Atom(b"test"), b"tail"), decode(b"\x83d\0\4testtail"))
+        atom, _ = decode(b"\x83d\0\4test")
+        self.assertTrue(atom is decode(b"\x83d\0\4test")[0])
+        self.assertRaises(ValueError, decode, b"\x83d\1\0" + b"X" * 256)
 
     def test_decode_predefined_atoms(self):
         self.assertEqual((True, b""), decode(b"\x83d\0\4true"))
@@ -178,6 +195,9 @@ class DecodeTestCase(unittest.TestCase):
         self.assertRaises(IncompleteData, decode, b"\x83l\0\0")
         self.assertRaises(IncompleteData, decode, b"\x83l\0\0\0")
         self.assertRaises(IncompleteData, decode, b"\x83l\0\0\0\0")
+        self.assertRaises(IncompleteData, decode, b"\x83l\xff\xff\xff\xffj")
+        self.assertRaises(IncompleteData, decode, b"\x83l\0\0\0\5jjjjj")
+        self.assertEqual(([[]] * 5, b""), decode(b"\x83l\0\0\0\5jjjjjj"))
         # Elang use 'j' tag for empty lists
         self.assertEqual(([], b""), decode(b"\x83l\0\0\0\0j"))
         self.assertEqual(([], b"tail"), decode(b"\x83l\0\0\0\0jtail"))
@@ -207,6 +227,7 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual((([], []), b"tail"), decode(b"\x83h\2jjtail"))
 
     def test_decode_large_tuple(self):
+        self.assertRaises(IncompleteData, decode, b"\x83i\xff\xff\xff\xffj")
         self.assertRaises(IncompleteData, decode, b"\x83i")
         self.assertRaises(IncompleteData, decode, b"\x83i\0")
         self.assertRaises(IncompleteData, decode, b"\x83i\0\0")
@@ -299,6 +320,10 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual((-6618611909121, b""), decode(b"\x83n\6\1\1\2\3\4\5\6"))
         self.assertEqual((6618611909121, b"tail"),
             decode(b"\x83n\6\0\1\2\3\4\5\6tail"))
+        self.assertEqual((2 ** 1000, b""), decode(encode(2 ** 1000)))
+        self.assertEqual((-2 ** 1000, b""), decode(encode(-2 ** 1000)))
+        self.assertEqual((2 ** 64 - 1, b""), decode(encode(2 ** 64 - 1)))
+        self.assertEqual((-2 ** 63, b""), decode(encode(-2 ** 63)))
 
     def test_decode_big_integer(self):
         self.assertRaises(IncompleteData, decode, b"\x83o")
@@ -316,6 +341,8 @@ class DecodeTestCase(unittest.TestCase):
             decode(b"\x83o\0\0\0\6\1\1\2\3\4\5\6"))
         self.assertEqual((6618611909121, b"tail"),
             decode(b"\x83o\0\0\0\6\0\1\2\3\4\5\6tail"))
+        self.assertEqual((2 ** 2048, b""), decode(encode(2 ** 2048)))
+        self.assertEqual((-2 ** 2048, b""), decode(encode(-2 ** 2048)))
 
     def test_decode_compressed_term(self):
         self.assertRaises(IncompleteData, decode, b"\x83P")
@@ -325,10 +352,52 @@ class DecodeTestCase(unittest.TestCase):
         self.assertRaises(IncompleteData, decode, b"\x83P\0\0\0\0")
         self.assertRaises(ValueError, decode, b"\x83P\0\0\0\x16"
             b"\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50")
+        self.assertRaises(ValueError, decode, b"\x83P\0\0\0\x18"
+            b"\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50")
         self.assertEqual(([100] * 20, b""), decode(b"\x83P\0\0\0\x17"
             b"\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50"))
         self.assertEqual(([100] * 20, b"tail"), decode(b"\x83P\0\0\0\x17"
             b"\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50tail"))
+        term = [(Atom(b"test"), b"X" * 1000, 1.5)] * 1000
+        self.assertEqual((term, b"tail"), decode(encode(term, True) + b"tail"))
+
+    def test_decode_into(self):
+        data = bytearray(b"tail\x83h\3d\0\4testm\0\0\0\3bink\0\2\1\2tail")
+        self.assertEqual(((Atom(b"test"), b"bin", [1, 2]), 27),
+            decode_into(data, 4))
+        term, pos = decode_into(data, 4, zero_copy=True)
+        self.assertEqual(27, pos)
+        self.assertEqual(memoryview, type(term[1]))
+        self.assertEqual(b"bin", bytes(term[1]))
+        # The buffer can't be resized while the binary is alive
+        self.assertRaises(BufferError, data.extend, b"x")
+        del term
+        data.extend(b"x")
+        del data[-1]
+        self.assertEqual(((1, 2), 7), decode_into(b"\x83h\2a\1a\2tail"))
+        self.assertEqual(((1, 2), 7),
+            decode_into(array("H", b"\x83h\2a\1a\2\0")))
+        self.assertRaises(IncompleteData, decode_into, data, 31)
+        self.assertRaises(IncompleteData, decode_into, data[:20], 4)
+        self.assertRaises(ValueError, decode_into, data, 0)
+        self.assertRaisesRegex(ValueError, r"^unsupported data: b'z'$",
+            decode_into, bytearray(b"\x83z"))
+        data = bytearray(b"tail" + encode(["x" * 100], compressed=True))
+        self.assertEqual(([List([120] * 100)], len(data)),
+            decode_into(data, 4))
+
+    def test_decode_into_incomplete_data(self):
+        data = bytearray(b"tail\x83h\2m\0\0\0\1xa")
+        try:
+            decode_into(data, 4, zero_copy=True)
+        except IncompleteData as e:
+            self.assertEqual(b"\x83h\2m\0\0\0\1xa", e.data)
+            # The buffer can be extended while the exception is alive
+            data += b"\1"
+        else:
+            self.fail("IncompleteData expected")
+        self.assertEqual(((b"x", 1), 15), decode_into(data, 4))
+
 
 class EncodeTestCase(unittest.TestCase):
 
@@ -338,6 +407,11 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual(b"\x83h\xff" + b"h\0" * 255, encode(tuple([()] * 255)))
         self.assertEqual(b"\x83i\0\0\1\0" + b"h\0" * 256,
             encode(tuple([()] * 256)))
+        self.assertEqual(b"\x83h\x10" + b"a\1" * 16, encode((1,) * 16))
+        self.assertEqual(b"\x83h\x10" + b"a\1" * 14 + b"b\0\0\1\0a\1",
+            encode((1,) * 14 + (256, 1)))
+        self.assertEqual(b"\x83h\x10" + b"a\1" * 14 + b"d\0\4truea\1",
+            encode((1,) * 14 + (True, 1)))
 
     def test_encode_empty_list(self):
         self.assertEqual(b"\x83j", encode([]))
@@ -352,6 +426,20 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual(b"\x83l\0\0\0\5jjjjjj", encode([[], [], [], [], []]))
         self.assertEqual(b"\x83l\0\0\0\5jjjjjj",
             encode(List([List([]), List([]), List([]), List([]), List([])])))
+        self.assertEqual(b"\x83l\0\1\0\0" + b"a\1" * 65536 + b"j",
+            encode([1] * 65536))
+        self.assertEqual(b"\x83l\0\1\0\0" + b"a\1" * 65535 + b"b\0\0\1\0j",
+            encode([1] * 65535 + [256]))
+
+    def test_encode_byte_list(self):
+        self.assertEqual(b"\x83j", encode(bytearray()))
+        self.assertEqual(b"\x83k\0\4test", encode(bytearray(b"test")))
+        self.assertEqual(b"\x83k\xff\xff" + b"X" * 65535,
+            encode(bytearray(b"X" * 65535)))
+        self.assertEqual(b"\x83l\0\1\0\0" + b"aX" * 65536 + b"j",
+            encode(bytearray(b"X" * 65536)))
+        self.assertEqual(([1, 2, 255], b""),
+            decode(encode(bytearray([1, 2, 255]))))
 
     def test_encode_improper_list(self):
         self.assertEqual(b"\x83l\0\0\0\1h\0h\0", encode(ImproperList([()], ())))
@@ -362,6 +450,7 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual(b"\x83k\0\4test", encode("test"))
         self.assertEqual(b"\x83k\0\2\0\xff", encode("\0\xff"))
         self.assertEqual(b"\x83l\0\0\0\1b\0\0\1\0j", encode("\u0100"))
+        self.assertEqual(b"\x83l\0\0\0\2aab\0\0\1\0j", encode("a\u0100"))
         self.assertEqual(b"\x83l\0\0\0\4b\0\0\4Bb\0\0\x045b\0\0\4Ab\0\0\4Bj",
             encode("\u0442\u0435\u0441\u0442"))
         self.assertEqual(b"\x83l\0\1\0\0" + b"aX" * 65536 + b"j",
@@ -372,6 +461,21 @@ class EncodeTestCase(unittest.TestCase):
     def test_encode_atom(self):
         self.assertEqual(b"\x83d\0\0", encode(Atom(b"")))
         self.assertEqual(b"\x83d\0\4test", encode(Atom(b"test")))
+        self.assertEqual(b"\x83d\0\4test", encode(Atom(b"test")))
+        # The cache is shared by the module so restore it for other tests
+        encoded_atoms = erlterms._encoded_atoms
+        saved = encoded_atoms.copy()
+        encoded_atoms.clear()
+        try:
+            for i in range(erlterms._MAX_ENCODED_ATOMS + 1):
+                name = ("atom%d" % i).encode("ascii")
+                self.assertEqual(b"\x83d\0" + bytes((len(name),)) + name,
+                    encode(Atom(name)))
+            self.assertEqual(erlterms._MAX_ENCODED_ATOMS,
+                len(encoded_atoms))
+        finally:
+            encoded_atoms.clear()
+            encoded_atoms.update(saved)
 
     def test_encode_string(self):
         self.assertEqual(b"\x83m\0\0\0\0", encode(b""))
@@ -438,6 +542,29 @@ class EncodeTestCase(unittest.TestCase):
             b"x\x01\xcba``\xe0\xcfB\x03\x00B@\x07\x1c",
             encode([[]] * 15, 1))
 
+    def test_make_encoder(self):
+        call = Atom(b"call")
+        encode_call = make_encoder((call, Atom, Atom, list))
+        self.assertEqual(encode((call, Atom(b"m"), Atom(b"f"), [1, 2])),
+            encode_call(Atom(b"m"), Atom(b"f"), [1, 2]))
+        # Arguments of other types are encoded as usual
+        self.assertEqual(encode((call, 1, "f", (1,))),
+            encode_call(1, "f", (1,)))
+        encode_reply = make_encoder((Atom(b"r"), int, object))
+        self.assertEqual(encode((Atom(b"r"), 1, 2.5)), encode_reply(1, 2.5))
+        self.assertEqual(encode((Atom(b"r"), 1, set([1]))),
+            encode_reply(1, set([1])))
+        self.assertEqual(encode(((1, (2, [])), "x")),
+            make_encoder(((int, (int, list)), "x"))(1, 2, []))
+        self.assertEqual(encode((1,) * 256),
+            make_encoder((1,) * 255 + (int,))(1))
+        # More than 255 placeholders
+        items = tuple(range(300))
+        self.assertEqual(encode(items),
+            make_encoder((int,) * 300)(*items))
+        self.assertEqual(encode(1), make_encoder(int)(1))
+        self.assertEqual(encode(()), make_encoder(())())
+
 def get_suite():
     load = unittest.TestLoader().loadTestsFromTestCase
     suite = unittest.TestSuite()